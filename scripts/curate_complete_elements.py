@@ -4,8 +4,12 @@
 import argparse
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 import re
-from concurrent.futures import ProcessPoolExecutor, as_completed
+
+_CHR_RE = re.compile(r"chr(\d+)")
 
 def load_ucsc_rmsk(rmsk_path):
     """
@@ -19,25 +23,35 @@ def load_ucsc_rmsk(rmsk_path):
         "repStart", "repEnd", "repLeft", "id"
     ]
     usecols = ["chr", "start", "end", "subfamily", "class", "strand"]
-    dtype = {
-        "chr": str,
-        "start": np.int32,
-        "end": np.int32,
-        "subfamily": str,
-        "class": str,
-        "strand": str
+    # Dictionary-encode the string columns so they arrive in pandas as
+    # categoricals and comparisons run on integer codes
+    category = pa.dictionary(pa.int32(), pa.string())
+    column_types = {
+        "chr": category,
+        "start": pa.int32(),
+        "end": pa.int32(),
+        "subfamily": category,
+        "class": category,
+        "strand": category
     }
-    te_bed = pd.read_csv(
+    reader = pa_csv.open_csv(
         rmsk_path,
-        sep="\t",
-        header=None,
-        names=colnames,
-        usecols=usecols,
-        dtype=dtype,
-        engine="c"
+        read_options=pa_csv.ReadOptions(column_names=colnames, block_size=64 << 20),
+        parse_options=pa_csv.ParseOptions(delimiter="\t"),
+        convert_options=pa_csv.ConvertOptions(include_columns=usecols, column_types=column_types)
     )
-    te_bed = te_bed[~te_bed["subfamily"].str.contains("Simple_repeat|Low_complexity|Satellite", regex=True)]
-    te_bed = te_bed[te_bed["strand"].isin(["+", "-"])]
+    excluded_classes = pa.array(["Simple_repeat", "Low_complexity", "Satellite"])
+    valid_strands = pa.array(["+", "-"])
+    # Filter batch by batch while streaming, so peak memory tracks the
+    # filtered table rather than the full annotation
+    batches = []
+    for batch in reader:
+        keep = pc.and_(
+            pc.invert(pc.is_in(batch["class"], value_set=excluded_classes)),
+            pc.is_in(batch["strand"], value_set=valid_strands)
+        )
+        batches.append(batch.filter(keep))
+    te_bed = pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
     return te_bed
 
 
@@ -80,7 +94,7 @@ def parse_args():
 def sort_chromosomes(df, start_col="start"):
     # Extract numeric or special parts of chromosome names
     def chr_key(c):
-        match = re.match(r"chr(\d+)", c)
+        match = _CHR_RE.match(c)
         if match:
             return (0, int(match.group(1)))  # autosomes first
         elif c == "chrX":
@@ -92,41 +106,175 @@ def sort_chromosomes(df, start_col="start"):
         else:
             return (3, c)  # unplaced contigs etc.
 
+    # Evaluate chr_key once per distinct chromosome, then broadcast its rank
+    # back to the rows; chromosomes sharing a key share a rank
+    codes, chroms = pd.factorize(df["chr"])
+    keys = [chr_key(c) for c in chroms]
+    ranks = {key: rank for rank, key in enumerate(sorted(set(keys)))}
+
     df = df.copy()
-    df["chr_sort"] = df["chr"].apply(chr_key)
+    df["chr_sort"] = np.array([ranks[key] for key in keys], dtype=np.int32)[codes]
     df = df.sort_values(["chr_sort", start_col]).drop(columns=["chr_sort"]).reset_index(drop=True)
     return df
 
 
-def ltr_elements_from_dict(ltr_elements_dict):
-    return pd.DataFrame(ltr_elements_dict)
-
-def parallel_find_triplet(row_tuple, ltr_elements_dict, tolerance):
-    _, row = row_tuple
-    chrom = row["chr"]
-    strand = row["strand"]
-    int_start = row["start"]
-    int_end = row["end"]
-    ltr_elements = ltr_elements_from_dict(ltr_elements_dict)
-    ltrs_chr = ltr_elements.loc[(ltr_elements["chr"] == chrom) & (ltr_elements["strand"] == strand)]
-    ltr_up_mask = (abs(ltrs_chr["end"] - int_start) <= tolerance) & (ltrs_chr["end"] <= int_start)
-    ltr_down_mask = (abs(ltrs_chr["start"] - int_end) <= tolerance) & (ltrs_chr["start"] >= int_end)
-    ltr_up = ltrs_chr.loc[ltr_up_mask]
-    ltr_down = ltrs_chr.loc[ltr_down_mask]
-    if not ltr_up.empty and not ltr_down.empty:
-        up = ltr_up.iloc[ltr_up["end"].sub(int_start).abs().argsort().iloc[0]]
-        down = ltr_down.iloc[ltr_down["start"].sub(int_end).abs().argsort().iloc[0]]
-        return {
-            "chr": chrom,
-            "strand": strand,
-            "ltr_up_start": up["start"],
-            "ltr_up_end": up["end"],
-            "int_start": int_start,
-            "int_end": int_end,
-            "ltr_down_start": down["start"],
-            "ltr_down_end": down["end"]
+def group_coordinates(df):
+    """
+    Split a BED-like DataFrame into per-(chr, strand) int32 numpy arrays
+    of start and end coordinates
+    """
+    return {
+        key: (group["start"].to_numpy(dtype=np.int32), group["end"].to_numpy(dtype=np.int32))
+        for key, group in df.groupby(["chr", "strand"], observed=True, sort=False)
+    }
+
+
+def build_ltr_index(ltr_elements):
+    """
+    Index LTR coordinates per (chr, strand) for nearest-flank lookups.
+    Each entry holds the LTR starts and ends plus the orderings that sort
+    them, so the index can be built once and queried by any INT set
+    """
+    ltr_index = {}
+    for key, (starts, ends) in group_coordinates(ltr_elements).items():
+        # Order by start then end, and by end then start, so ties on the
+        # nearest coordinate resolve on coordinates whatever the input row order
+        by_start = np.lexsort((ends, starts))
+        by_end = np.lexsort((starts, ends))
+        ltr_index[key] = {
+            "start": starts,
+            "end": ends,
+            "by_start": by_start,
+            "by_end": by_end,
+            "sorted_start": starts[by_start],
+            "sorted_end": ends[by_end]
         }
-    return None
+    return ltr_index
+
+
+def find_group_triplets(int_starts, int_ends, ltrs, tolerance):
+    """
+    For INT elements and the indexed LTRs sharing one chromosome and strand,
+    find the nearest LTR ending at most `tolerance` bp upstream of each INT
+    start and the nearest LTR starting at most `tolerance` bp downstream of
+    each INT end. Returns the coordinates of every INT with both flanks found.
+    """
+    ltr_starts = ltrs["start"]
+    ltr_ends = ltrs["end"]
+    # Window bounds are widened to int64 so large tolerances neither
+    # overflow nor wrap around the int32 coordinate range
+    window_starts = int_starts.astype(np.int64) - tolerance
+    window_ends = int_ends.astype(np.int64) + tolerance
+
+    # Upstream: last LTR end <= INT start, searched over LTRs ordered by end
+    ends = ltrs["sorted_end"]
+    up_idx = np.searchsorted(ends, int_starts, side="right") - 1
+    up_ok = up_idx >= 0
+    up_idx = np.where(up_ok, up_idx, 0)
+    up_ok &= ends[up_idx] >= window_starts
+    # Among LTRs sharing the nearest end, deterministically keep the first
+    # one by start (the previous per-row argsort broke such ties arbitrarily)
+    up_idx = np.searchsorted(ends, ends[up_idx], side="left")
+    up = ltrs["by_end"][up_idx]
+
+    # Downstream: first LTR start >= INT end, searched over LTRs ordered by
+    # start; among LTRs sharing that start, the first one by end is kept
+    starts = ltrs["sorted_start"]
+    down_idx = np.searchsorted(starts, int_ends, side="left")
+    down_ok = down_idx < len(starts)
+    down_idx = np.where(down_ok, down_idx, 0)
+    down_ok &= starts[down_idx] <= window_ends
+    down = ltrs["by_start"][down_idx]
+
+    found = up_ok & down_ok
+    return {
+        "ltr_up_start": ltr_starts[up][found],
+        "ltr_up_end": ltr_ends[up][found],
+        "int_start": int_starts[found],
+        "int_end": int_ends[found],
+        "ltr_down_start": ltr_starts[down][found],
+        "ltr_down_end": ltr_ends[down][found]
+    }
+
+
+def find_triplets(int_elements, ltr_index, tolerance):
+    """
+    Find the flanking LTRs of every INT element, returning one row per
+    INT with both flanks found
+    """
+    # Each (chr, strand) group is a single vectorized search, cheap enough
+    # that dispatching groups to worker processes costs more than it saves.
+    # Group results stay as numpy arrays and are concatenated once, so no
+    # per-group DataFrame is built
+    keys = []
+    results = []
+    for key, (int_starts, int_ends) in group_coordinates(int_elements).items():
+        if key in ltr_index:
+            keys.append(key)
+            results.append(find_group_triplets(int_starts, int_ends, ltr_index[key], tolerance))
+
+    columns = [
+        "chr", "strand",
+        "ltr_up_start", "ltr_up_end",
+        "int_start", "int_end",
+        "ltr_down_start", "ltr_down_end"
+    ]
+    if not results:
+        return pd.DataFrame(columns=columns).astype({col: np.int32 for col in columns[2:]})
+
+    counts = [len(result["int_start"]) for result in results]
+    triplets = {
+        # Categorical keys (lexically ordered categories) sort and compare by code
+        "chr": pd.Categorical(np.repeat([chrom for chrom, _ in keys], counts)),
+        "strand": pd.Categorical(np.repeat([strand for _, strand in keys], counts))
+    }
+    for col in columns[2:]:
+        triplets[col] = np.concatenate([result[col] for result in results])
+    return pd.DataFrame(triplets)
+
+
+def collapse_triplets(triplets):
+    """
+    Merge triplets sharing both flanking LTRs into one element spanning
+    the outermost INT coordinates
+    """
+    group_cols = [
+        "chr", "strand",
+        "ltr_up_start", "ltr_up_end",
+        "ltr_down_start", "ltr_down_end"
+    ]
+    # Sort once so each group is a contiguous run, then reduce every run
+    # starting at the rows where any key column changes
+    triplets = triplets.sort_values(group_cols).reset_index(drop=True)
+    changed = np.zeros(len(triplets) - 1, dtype=bool)
+    for col in group_cols:
+        values = triplets[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.codes
+        values = values.to_numpy()
+        changed |= values[1:] != values[:-1]
+    run_starts = np.concatenate(([0], np.flatnonzero(changed) + 1))
+
+    collapsed = triplets.loc[run_starts, group_cols].reset_index(drop=True)
+    collapsed["int_start"] = np.minimum.reduceat(triplets["int_start"].to_numpy(), run_starts)
+    collapsed["int_end"] = np.maximum.reduceat(triplets["int_end"].to_numpy(), run_starts)
+    return collapsed
+
+
+def write_csv(df, output_file):
+    """
+    Write a DataFrame as unquoted CSV with Arrow's multithreaded writer
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with open(output_file, "wb") as out:
+        # Arrow always quotes header names, so write the header ourselves
+        out.write((",".join(df.columns) + "\n").encode())
+        pa_csv.write_csv(
+            table,
+            out,
+            write_options=pa_csv.WriteOptions(include_header=False, quoting_style="none")
+        )
+
 
 def main():
     args = parse_args()
@@ -140,77 +288,35 @@ def main():
     print(f"Loaded {len(te_bed):,} RepeatMasker records")
     print(te_bed.head())
 
-    int_elements = te_bed[te_bed['subfamily'] == int_of_interest].sort_values(["chr", "start"]).reset_index(drop=True)
-    ltr_elements = te_bed[te_bed['subfamily'] == ltr_of_interest].sort_values(["chr", "start"]).reset_index(drop=True)
+    # No pre-sorting needed: the LTR index sorts its own coordinates and
+    # the collapsed output is sorted once at the end
+    int_elements = te_bed[te_bed['subfamily'] == int_of_interest]
+    ltr_elements = te_bed[te_bed['subfamily'] == ltr_of_interest]
 
-    int_elements = sort_chromosomes(int_elements)
-    ltr_elements = sort_chromosomes(ltr_elements)
-
-    triplets = []
-
-
-    # Prepare for parallel processing
-    int_rows = list(int_elements.iterrows())
-    ltr_elements_dict = ltr_elements.to_dict("list")
-
-    with ProcessPoolExecutor() as executor:
-        futures = [executor.submit(parallel_find_triplet, row_tuple, ltr_elements_dict, tolerance) for row_tuple in int_rows]
-        for future in as_completed(futures):
-            result = future.result()
-            if result is not None:
-                triplets.append(result)
-
-    ltr_elements_full = pd.DataFrame(triplets)
+    ltr_index = build_ltr_index(ltr_elements)
+    ltr_elements_full = find_triplets(int_elements, ltr_index, tolerance)
 
     if ltr_elements_full.empty:
         print("No complete elements found with the given parameters.")
         return
 
-    group_cols = [
-        "chr", "strand",
-        "ltr_up_start", "ltr_up_end",
-        "ltr_down_start", "ltr_down_end"
-    ]
-
     ltr_elements_full_collapsed = (
-        ltr_elements_full
-        .groupby(group_cols, as_index=False)
-        .agg(
-            int_start=("int_start", "min"),
-            int_end=("int_end", "max")
-        )
+        collapse_triplets(ltr_elements_full)
         .sort_values(["chr", "ltr_up_start", "int_start"])
         .reset_index(drop=True)
     )
 
-
-    ltr_elements_full_collapsed = ltr_elements_full_collapsed.assign(
-        ltr_5_start=np.where(
-            ltr_elements_full_collapsed["strand"] == "+",
-            ltr_elements_full_collapsed["ltr_up_start"],
-            ltr_elements_full_collapsed["ltr_down_start"]
-        ),
-        ltr_5_end=np.where(
-            ltr_elements_full_collapsed["strand"] == "+",
-            ltr_elements_full_collapsed["ltr_up_end"],
-            ltr_elements_full_collapsed["ltr_down_end"]
-        ),
-        ltr_3_start=np.where(
-            ltr_elements_full_collapsed["strand"] == "+",
-            ltr_elements_full_collapsed["ltr_down_start"],
-            ltr_elements_full_collapsed["ltr_up_start"]
-        ),
-        ltr_3_end=np.where(
-            ltr_elements_full_collapsed["strand"] == "+",
-            ltr_elements_full_collapsed["ltr_down_end"],
-            ltr_elements_full_collapsed["ltr_up_end"]
-        )
-    )
+    # Orient flanks by strand in one pass: on + the upstream LTR is 5',
+    # on - the columns swap so the downstream LTR becomes 5'
+    is_plus = (ltr_elements_full_collapsed["strand"].to_numpy() == "+")
+    flanks = ltr_elements_full_collapsed[["ltr_up_start", "ltr_up_end", "ltr_down_start", "ltr_down_end"]].to_numpy()
+    oriented = np.where(is_plus[:, None], flanks, flanks[:, [2, 3, 0, 1]])
+    ltr_elements_full_collapsed[["ltr_5_start", "ltr_5_end", "ltr_3_start", "ltr_3_end"]] = oriented
 
     # Sort by chromosome order using sort_chromosomes, use ltr_5_start as the start column
     ltr_elements_full_collapsed = sort_chromosomes(ltr_elements_full_collapsed, start_col="ltr_5_start")
 
-    ltr_elements_full_collapsed.to_csv(output_file, index=False)
+    write_csv(ltr_elements_full_collapsed, output_file)
     print(f"Saved {len(ltr_elements_full_collapsed)} complete elements to {output_file}")
 
 